@@ -1,8 +1,17 @@
 import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import cached_property, lru_cache
 
 import numpy as np
-from arpys import dl, pp
-from data_slicer import cmaps, plugin
+from data_slicer import plugin
+
+@lru_cache(maxsize=8)
+def _units_factor(units) :
+    """ Return the factor that converts k values from inverse Angstrom to 
+    units of pi/*units*.
+    """
+    return units/np.pi
 
 class DatasetError(Exception) :
     """ Error raised when the type of data found does not conform to our 
@@ -10,6 +19,55 @@ class DatasetError(Exception) :
     """
     pass
 
+# The numba-compiled normalization kernel, built on first use by 
+# `_get_normalize_kernel`. False if numba is not available.
+_normalize_cube = None
+
+def _get_normalize_kernel() :
+    """ Return the compiled per-segment normalization kernel, or None if 
+    numba is not installed. numba is optional and, as it is slow to import, 
+    only imported on the first call.
+
+    The kernel ``kernel(data, dim, use_min)`` normalizes every segment (row 
+    if *dim* is 0, column if *dim* is 1) of every slice *data[z]* of the 
+    floating point array *data* of shape (nz, nx, ny) in place by its 
+    maximum or, if *use_min* is True, by its minimum, like :func: 
+    `normalize_per_segment <arpys.postprocessing.normalize_per_segment>`. 
+    Segments whose norm is zero are left untouched and, as in arpys, 
+    segments containing NaN become all NaN. The compiled kernel is cached 
+    on disk, so it is only compiled once and not in every session.
+    """
+    global _normalize_cube
+    if _normalize_cube is None :
+        try :
+            from numba import njit, prange
+        except ImportError :
+            _normalize_cube = False
+        else :
+            @njit(parallel=True, cache=True)
+            def kernel(data, dim, use_min) :
+                for z in prange(data.shape[0]) :
+                    plane = data[z]
+                    for s in range(plane.shape[dim]) :
+                        if dim == 0 :
+                            seg = plane[s,:]
+                        else :
+                            seg = plane[:,s]
+                        # numba's min and max skip NaN, while numpy's (and 
+                        # thereby arpys') propagate it
+                        if np.isnan(seg).any() :
+                            seg[:] = np.nan
+                            continue
+                        if use_min :
+                            m = seg.min()
+                        else :
+                            m = seg.max()
+                        if m != 0 :
+                            seg /= m
+                return data
+            _normalize_cube = kernel
+    return _normalize_cube or None
+
 class ARPES_Plugin(plugin.Plugin) :
     """ A plugin which connects the analysis functionalities of the `aprys` 
     module with PIT.
@@ -17,22 +75,69 @@ class ARPES_Plugin(plugin.Plugin) :
 
     _message = 'No ARPES data has been found. Load data with `load_data()`.'
     filename = '<missing filename>'
+    # Maximum number of k-space meshes kept in the `a2k` cache
+    _a2k_cache_size = 8
+    # The arpys modules are only imported on first use, see `_arpys`
+    _dl = None
+    _pp = None
 
     def __init__(self, *args, **kwargs) :
         super().__init__(*args, **kwargs)
         self.name = 'ARPES plugin'
         self.shortname = 'arpes'
 
-        # Make arpys module accessible
-        self.dl = dl
-        self.pp = pp
+        # Cache of k-space meshes computed by `a2k`, in inverse Angstrom
+        self._a2k_cache = OrderedDict()
+        # Wavevector lengths per (hv, work_func), see `_k0`
+        self._kprefactor_cache = {}
+
+        # Reusable output buffers for the normalization previews, one per plot
+        self._norm_bufs = {}
+
+        # The arpys data Namespace, set by `load_data`
+        self.D = None
+
+        # Whether axes redraws are currently deferred and whether any axes 
+        # changed since, see `batch`
+        self._batching = False
+        self._axes_dirty = False
 
-    def load_data(self, filename) :
+    def _arpys(self) :
+        """ Import the arpys modules on first use and return them as the 
+        tuple (dl, pp).
+        """
+        if self._dl is None :
+            from arpys import dl, pp
+            self._dl, self._pp = dl, pp
+        return self._dl, self._pp
+
+    @property
+    def dl(self) :
+        """ The `arpys.dataloaders` module. """
+        return self._arpys()[0]
+
+    @property
+    def pp(self) :
+        """ The `arpys.postprocessing` module. """
+        return self._arpys()[1]
+
+    def load_data(self, filename, precision=None) :
         """ Load a set of ARPES data and bring it into PIT-friendly form. 
         Also return the arpys data Namespace for inspection.
+
+        *Parameters*
+        =========  =============================================================
+        filename   str; path to the file to load.
+        precision  numpy dtype or None; if given, the data is converted to 
+                   this type after loading, e.g. 'float32' to halve the 
+                   memory footprint of float64 data. *None* keeps the dtype 
+                   provided by the loader.
+        =========  =============================================================
         """
         # Retrieve the data in arpys format and store it
-        D = dl.load_data(filename)
+        D = self.dl.load_data(filename)
+        if precision is not None :
+            D.data = D.data.astype(precision, copy=False)
         self.D = D
 
         # Set the loaded data in PIT
@@ -42,27 +147,13 @@ class ARPES_Plugin(plugin.Plugin) :
 
         return D
 
-    def load(self, filename) :
-        """ Load a set of ARPES data and bring it into PIT-friendly form. 
-        Also return the arpys data Namespace for inspection.
-
-        This is a convenience alias for :func: `load_data 
-        <ds_arpes_plugin.ARPES_Plugin.load_data`.
-        """
-        return self.load_data(filename)
-
-    def open(self, filename) :
-        """ Load a set of ARPES data and bring it into PIT-friendly form. 
-        Also return the arpys data Namespace for inspection.
-
-        This is a convenience alias for :func: `load_data 
-        <ds_arpes_plugin.ARPES_Plugin.load_data`.
-        """
-        return self.load_data(filename)
+    # Convenience aliases for `load_data`
+    load = load_data
+    open = load_data
 
     def _check_for_arpes_data(self) :
         """ Check if ARPES data has been loaded or raise an exception. """
-        if not hasattr(self, 'D') :
+        if self.D is None :
             raise DatasetError(self._message)
 
     def a2k(self, alpha_axis, beta_axis=None, dalpha=0, dbeta=0, 
@@ -108,42 +199,248 @@ class ARPES_Plugin(plugin.Plugin) :
         """
         self._check_for_arpes_data()
 
-        # Fetch correct axes
+        axes = self._rolled_axes()
+        alpha, beta = self._get_angles(axes, alpha_axis, beta_axis)
+        if hv is None : hv = self.D.hv
+
+        # Convert angles to k-space, reusing a previous result if possible
+        KX, KY = self._cached_angle_to_k(alpha, beta, hv, dalpha, dbeta, 
+                                         orientation, work_func)
+        
+        if units!=0 :
+            inv = _units_factor(units)
+            np.multiply(KX, inv, out=KX)
+            np.multiply(KY, inv, out=KY)
+
+        self._update_axes(axes, alpha_axis, beta_axis, KX, KY)
+
+        return KX, KY
+
+    def a2k_batch(self, alpha_axis, beta_axis=None, dalphas=0, dbetas=0, 
+                  orientation='horizontal', work_func=4, units=0, hv=None) :
+        """ Convert the axes from angles to k-space for a whole series of 
+        offsets, photon energies or work functions at once.
+        *dalphas*, *dbetas*, *work_func* and *hv* can be given as scalars or 
+        as 1D arrays, which are broadcast against each other to N sets of 
+        parameters. All other arguments are as in :func: `a2k 
+        <ds_arpes_plugin.ARPES_Plugin.a2k>`. Only the last set of 
+        parameters is used to update the axes in PIT.
+
+        *Returns*
+        ==  ====================================================================
+        KX  array of shape (N, nkx, nky); the meshes of k values in parallel 
+            direction for each set of parameters.
+        KY  array of shape (N, nkx, nky); the meshes of k values in 
+            perpendicular direction for each set of parameters.
+        ==  ====================================================================
+        """
+        self._check_for_arpes_data()
+
+        axes = self._rolled_axes()
+        alpha, beta = self._get_angles(axes, alpha_axis, beta_axis)
+        if hv is None : hv = self.D.hv
+        dalphas, dbetas, hvs, wfs = np.broadcast_arrays(
+            np.atleast_1d(dalphas), np.atleast_1d(dbetas), 
+            np.atleast_1d(hv), np.atleast_1d(work_func))
+        k0 = np.array([self._k0(h, w) for h, w in zip(hvs, wfs)])
+        KX, KY = self._angle_to_k_fast(alpha, beta, k0, dalphas, dbetas, 
+                                       orientation)
+
+        if units!=0 :
+            inv = _units_factor(units)
+            np.multiply(KX, inv, out=KX)
+            np.multiply(KY, inv, out=KY)
+
+        self._update_axes(axes, alpha_axis, beta_axis, KX[-1], KY[-1])
+
+        return KX, KY
+
+    @contextmanager
+    def batch(self) :
+        """ Context manager that defers redrawing the axes in PIT until the 
+        end of the block. Use this to avoid a redraw for every call when 
+        running :func: `a2k <ds_arpes_plugin.ARPES_Plugin.a2k>` in a loop::
+
+            with arpes.batch() :
+                for dalpha in offsets :
+                    arpes.a2k(0, dalpha=dalpha)
+        """
+        previous = self._batching
+        self._batching = True
+        try :
+            yield self
+        finally :
+            self._batching = previous
+        # Only the outermost block redraws, and only if any axes changed. 
+        # This is skipped if the block raised, so that the original 
+        # exception is not masked.
+        if not previous and self._axes_dirty :
+            self._axes_dirty = False
+            self.main_window.set_axes()
+
+    def _rolled_axes(self) :
+        """ Return the original axes in the order in which they currently 
+        appear in PIT, as a tuple of three contiguous 1D arrays.
+        """
+        # The original axes are rolled by the current roll state, i.e. axis 
+        # k in PIT corresponds to original axis (k + shift) % n. Pulling the 
+        # axes out into standalone arrays avoids going through the object 
+        # array PIT may keep them in for every access.
         axes = self.data_handler.original_axes
-        i = self.data_handler._roll_state
-        axes = np.roll(axes, -i)
+        n = 3
+        shift = self.data_handler._roll_state
+        return tuple(np.ascontiguousarray(axes[(k + shift) % n]) 
+                     for k in range(n))
+
+    def _get_angles(self, axes, alpha_axis, beta_axis) :
+        """ Return the original (angle) axes *alpha* and *beta* that 
+        currently sit at the positions *alpha_axis* and *beta_axis* in PIT, 
+        given the output *axes* of :func: `_rolled_axes 
+        <ds_arpes_plugin.ARPES_Plugin._rolled_axes>`. If *beta_axis* is 
+        None, *beta* is the single angle 0.
+        """
         alpha = axes[alpha_axis]
         if beta_axis is not None :
             beta = axes[beta_axis]
         else :
             beta = np.array([0])
+        return alpha, beta
 
-        if hv is None : hv = self.D.hv
-
-        # Convert angles to k-space
-        KX, KY = pp.angle_to_k(alpha, beta, hv, dalpha=dalpha, dbeta=dbeta, 
-                               orientation=orientation, work_func=work_func)
-        
-        if units!=0 :
-            KX /= (np.pi/units)
-            KY /= (np.pi/units)
-
-        # Update PIT
-        new_alpha = KY[:,0]
+    def _update_axes(self, axes, alpha_axis, beta_axis, KX, KY) :
+        """ Set the k values from the meshes *KX* and *KY* as the axes 
+        *alpha_axis* and *beta_axis* in PIT, restore all other axes to their 
+        original values *axes* (as returned by :func: `_rolled_axes 
+        <ds_arpes_plugin.ARPES_Plugin._rolled_axes>`) and redraw.
+        """
+        # The column KY[:,0] is strided, so copy it into a contiguous array 
+        # once instead of leaving that to every consumer
+        new_alpha = np.ascontiguousarray(KY[:,0])
         self.data_handler.axes[alpha_axis] = new_alpha
         if beta_axis is not None :
-            new_beta = KX[0]
+            new_beta = np.ascontiguousarray(KX[0])
             self.data_handler.axes[beta_axis] = new_beta
 
         # Reset all unaffected axes (necessary when several a2k runs with 
         # different axes are executed)
-        for i in range(3) :
-            if i not in [alpha_axis, beta_axis] :
-                self.data_handler.axes[i] = axes[i]
+        skip = {alpha_axis, beta_axis}
+        for k, axis in enumerate(axes) :
+            if k not in skip :
+                self.data_handler.axes[k] = axis
+
+        # Update the axes visually, unless this is deferred by `batch`
+        if self._batching :
+            self._axes_dirty = True
+        else :
+            self._axes_dirty = False
+            self.main_window.set_axes()
+
+    def _cached_angle_to_k(self, alpha, beta, hv, dalpha, dbeta, orientation, 
+                           work_func) :
+        """ Return copies of the k-space meshes for the given angles and 
+        parameters, computing them only if the same set of parameters has 
+        not been seen in one of the recent calls.
+        """
+        alpha = np.asarray(alpha)
+        beta = np.asarray(beta)
+        key = (alpha.tobytes(), beta.tobytes(), float(hv), float(dalpha), 
+               float(dbeta), orientation.lower()[0], float(work_func))
+        cache = self._a2k_cache
+        if key in cache :
+            cache.move_to_end(key)
+            KX, KY = cache[key]
+        else :
+            k0 = self._k0(hv, work_func)
+            # If the cache is full, evict the oldest entry first and recycle 
+            # its meshes as output buffers. The cached arrays are never 
+            # handed out, so nothing else can hold a reference to them.
+            out = None
+            if len(cache) >= self._a2k_cache_size :
+                _, old = cache.popitem(last=False)
+                out = tuple(K[None] for K in old)
+            KX, KY = self._angle_to_k_fast(alpha, beta, k0, dalpha, dbeta, 
+                                           orientation, out=out)
+            KX, KY = KX[0], KY[0]
+            cache[key] = (KX, KY)
+
+        # Hand out copies such that the cached meshes stay in inverse Angstrom
+        return KX.copy(), KY.copy()
 
-        # Update the axes visually
-        self.main_window.set_axes()
+    @cached_property
+    def _deg2rad(self) :
+        """ Conversion factor from degrees to radians. """
+        return np.float64(np.pi/180.0)
+
+    def _k0(self, hv, work_func) :
+        """ Return the length of the photoelectron wavevector in inverse 
+        Angstrom for photon energy *hv* and work function *work_func* (in 
+        eV). Results are memoized per (*hv*, *work_func*).
+        """
+        key = (float(hv), float(work_func))
+        k0 = self._kprefactor_cache.get(key)
+        if k0 is None :
+            # sqrt(2*m_e)/hbar, using the same value as arpys
+            k0 = 0.5124 * np.sqrt(key[0] - key[1])
+            self._kprefactor_cache[key] = k0
+        return k0
 
+    def _angle_to_k_fast(self, alpha, beta, k0, dalpha, dbeta, orientation, 
+                         out=None) :
+        """ Convert the angles *alpha* and *beta* (1D arrays, in degrees) to 
+        meshes of k values, given the precomputed wavevector length *k0*. 
+        Follows the same conventions as :func: `angle_to_k 
+        <arpys.postprocessing.angle_to_k>`.
+        *k0*, *dalpha* and *dbeta* can be scalars or 1D arrays, which are 
+        broadcast against each other to N sets of parameters. The returned 
+        meshes KX and KY have shape (N, len(alpha), len(beta)). *out* can be 
+        a tuple of two float64 arrays (KX, KY) that are reused for the 
+        result if they have the right shape.
+        """
+        slit = orientation.lower()[0]
+        if slit not in 'hv' :
+            raise ValueError('*orientation* must start with "h" or "v", got '
+                             '"{}".'.format(orientation))
+
+        # Parameters as columns of shape (N, 1)
+        k0, dalpha, dbeta = [np.asarray(x, dtype=float)[:,None] for x in 
+                             np.broadcast_arrays(np.atleast_1d(k0), 
+                                                 np.atleast_1d(dalpha), 
+                                                 np.atleast_1d(dbeta))]
+        # Angles along the slit of shape (N, nalpha), in radians
+        a = np.asarray(alpha, dtype=float)[None,:] + dalpha
+        a *= self._deg2rad
+        beta = np.asarray(beta, dtype=float)[None,:]
+        shape = (a.shape[0], a.shape[1], beta.shape[1])
+        if out is not None and out[0].shape == shape :
+            KX, KY = out
+        else :
+            KX = np.empty(shape)
+            KY = np.empty_like(KX)
+
+        # Evaluate the trigonometric functions on the angle vectors only, 
+        # with k0 folded in, reusing the angle arrays as output buffers. 
+        # The meshes are then filled by a single broadcast each.
+        sa = np.sin(a)
+        sa *= k0
+        if slit == 'h' :
+            b = beta + dbeta
+            b *= self._deg2rad
+            ca = np.cos(a, out=a)
+            ca *= k0
+            sb = np.sin(b, out=b)
+            np.multiply(ca[:,:,None], sb[:,None,:], out=KX)
+            KY[:] = sa[:,:,None]
+        else :
+            # For a vertical slit, *dbeta* rotates the sample out of the 
+            # plane spanned by the slit and the angles *beta* (theta_k)
+            theta = beta * self._deg2rad
+            db = dbeta * self._deg2rad
+            ct = np.cos(theta)
+            st = np.sin(theta) * (k0 * np.cos(db))
+            ca = np.cos(a, out=a)
+            ca *= k0 * np.sin(db)
+            np.multiply(ca[:,:,None], ct[:,None,:], out=KX)
+            KX += st[:,None,:]
+            np.multiply(sa[:,:,None], ct[:,None,:], out=KY)
         return KX, KY
 
     def main_plot_normalize_per_segment(self, dim=0, min=False) :
@@ -159,7 +456,7 @@ class ARPES_Plugin(plugin.Plugin) :
         <ds_arpes_plugin.ARPES_Plugin.normalize_per_segment>`
         """
         data = self.main_window.main_plot.image_data
-        norm_data = pp.normalize_per_segment(data, dim=dim)
+        norm_data = self._normalize_image(data, dim, min, 'main_plot')
         self.main_window.set_image(norm_data, emit=False)
 
     def cut_plot_normalize_per_segment(self, dim=0, min=False) :
@@ -175,10 +472,34 @@ class ARPES_Plugin(plugin.Plugin) :
         <ds_arpes_plugin.ARPES_Plugin.normalize_per_segment>`
         """
         data = self.main_window.cut_plot.image_data
-        norm_data = pp.normalize_per_segment(data, dim=dim)
+        norm_data = self._normalize_image(data, dim, min, 'cut_plot')
         self.main_window.cut_plot.set_image(norm_data, 
                                             lut=self.main_window.lut) 
 
+    def _normalize_image(self, data, dim, min, name) :
+        """ Return the per-segment normalized version of the 2D array *data*. 
+        If the compiled kernel is available, the result is written into a 
+        buffer that is kept under *name* and reused as long as shape and 
+        dtype of the image do not change.
+        """
+        # Integer data has to be promoted to a floating point type, 
+        # otherwise the normalized values get truncated
+        dtype = np.result_type(data.dtype, np.float32)
+        kernel = _get_normalize_kernel()
+        if kernel is None :
+            # arpys normalizes in place, so hand it a copy to leave the 
+            # displayed source image untouched
+            return self.pp.normalize_per_segment(data.astype(dtype), dim=dim, 
+                                                 minimum=min)
+
+        buf = self._norm_bufs.get(name)
+        if buf is None or buf.shape != data.shape or buf.dtype != dtype :
+            buf = np.empty(data.shape, dtype=dtype)
+            self._norm_bufs[name] = buf
+        np.copyto(buf, data)
+        kernel(buf[None], dim, min)
+        return buf
+
     def normalize_per_segment(self, dim=0, min=False) :
         """ Apply :func: `normalize_per_segment 
         <arpys.postprocessing.normalize_per_segment>` to every slice along z.
@@ -193,7 +514,21 @@ class ARPES_Plugin(plugin.Plugin) :
         <ds_arpes_plugin.ARPES_Plugin.cut_plot_normalize_per_segment>`
         """
         data = self.data_handler.get_data()
-        for z in data.shape[-1] :
-            pp.normalize_per_segment(data[:,:,z], dim=dim)
-        self.data_handler.set_data(data)
+        # Integer data has to be promoted to a floating point type, 
+        # otherwise the normalized values get truncated
+        dtype = np.result_type(data.dtype, np.float32)
+        # Work on a copy of shape (nz, nx, ny) such that every slice along z 
+        # is a contiguous block of memory
+        cube = np.ascontiguousarray(np.moveaxis(data, -1, 0), dtype=dtype)
+        kernel = _get_normalize_kernel()
+        if kernel is not None :
+            # Normalize all slices at once in a single compiled call
+            kernel(cube, dim, min)
+        else :
+            pp = self.pp
+            for z in range(cube.shape[0]) :
+                cube[z] = pp.normalize_per_segment(cube[z], dim=dim, 
+                                                   minimum=min)
+        # Hand the result back to PIT in the original (nx, ny, nz) shape
+        self.data_handler.set_data(cube.transpose(1, 2, 0))
 
@@ -0,0 +1,183 @@
+""" Consistency checks of the plugin's own implementations against the 
+arpys functions they replace.
+"""
+import types
+
+import numpy as np
+import pytest
+
+pp = pytest.importorskip('arpys.postprocessing')
+
+from ds_arpes_plugin import ds_arpes_plugin as dap
+
+class _MainWindow :
+    """ Stand-in for PIT's main window that counts axes redraws. """
+    def __init__(self) :
+        self.redraws = 0
+
+    def set_axes(self) :
+        self.redraws += 1
+
+class _AxesHandler :
+    """ Stand-in for PIT's data handler holding only a set of axes. """
+    def __init__(self, axes) :
+        self.original_axes = np.empty(len(axes), dtype=object)
+        self.original_axes[:] = axes
+        self.axes = list(axes)
+        self._roll_state = 0
+
+def _make_a2k_plugin() :
+    """ Return an ARPES_Plugin with angle axes (alpha, beta, energy) and the 
+    arrays *alpha* and *beta*.
+    """
+    alpha = np.linspace(-15, 15, 7)
+    beta = np.linspace(-8, 8, 5)
+    energy = np.linspace(0, 1, 3)
+    plugin = dap.ARPES_Plugin(_MainWindow(), 
+                              _AxesHandler([alpha, beta, energy]))
+    plugin.D = types.SimpleNamespace(hv=60)
+    return plugin, alpha, beta
+
+def test_a2k_cache_keeps_results_independent() :
+    plugin, alpha, beta = _make_a2k_plugin()
+    n = plugin._a2k_cache_size + 3
+    calls = [dict(dalpha=i, dbeta=1, units=3*(i % 2)) for i in range(n)]
+    # Repeat a call that has been evicted and one that is still cached
+    calls += [calls[0], calls[n-2]]
+    results = []
+    for kwargs in calls :
+        KX, KY = plugin.a2k(0, 1, **kwargs)
+        results.append((KX, KY, KX.copy(), KY.copy()))
+
+    for kwargs, (KX, KY, KX_copy, KY_copy) in zip(calls, results) :
+        # Arrays handed out earlier must not have been overwritten
+        assert np.array_equal(KX, KX_copy)
+        assert np.array_equal(KY, KY_copy)
+        kx, ky = pp.angle_to_k(alpha, beta, 60, dalpha=kwargs['dalpha'], 
+                               dbeta=kwargs['dbeta'])
+        if kwargs['units'] :
+            kx, ky = [k * kwargs['units']/np.pi for k in (kx, ky)]
+        assert np.allclose(KX, kx)
+        assert np.allclose(KY, ky)
+
+@pytest.mark.parametrize('dim', [0, 1])
+@pytest.mark.parametrize('minimum', [False, True])
+@pytest.mark.parametrize('with_nan', [False, True])
+def test_normalize_cube_matches_arpys(dim, minimum, with_nan) :
+    pytest.importorskip('numba')
+    rng = np.random.default_rng(0)
+    cube = rng.random((3, 5, 4))
+    if with_nan :
+        cube[1,2,3] = np.nan
+    expected = np.array([pp.normalize_per_segment(plane.copy(), dim=dim, 
+                                                  minimum=minimum) 
+                         for plane in cube])
+    result = dap._get_normalize_kernel()(cube.copy(), dim, minimum)
+    assert np.allclose(result, expected, equal_nan=True)
+
+class _DataHandler :
+    """ Stand-in for PIT's data handler holding a single dataset. """
+    def __init__(self, data) :
+        self.data = data
+
+    def get_data(self) :
+        return self.data
+
+    def set_data(self, data) :
+        self.data = data
+
+@pytest.mark.parametrize('use_kernel', [True, False])
+@pytest.mark.parametrize('minimum', [False, True])
+def test_normalize_per_segment_matches_arpys(monkeypatch, use_kernel, 
+                                             minimum) :
+    if use_kernel :
+        pytest.importorskip('numba')
+    else :
+        monkeypatch.setattr(dap, '_normalize_cube', False)
+    rng = np.random.default_rng(1)
+    data = rng.random((5, 4, 3))
+    expected = np.stack([pp.normalize_per_segment(data[:,:,z].copy(), 
+                                                  minimum=minimum) 
+                         for z in range(data.shape[-1])], axis=-1)
+    plugin = dap.ARPES_Plugin(None, _DataHandler(data.copy()))
+    plugin.normalize_per_segment(min=minimum)
+    assert np.allclose(plugin.data_handler.data, expected)
+
+class _Recorder :
+    """ Stand-in for a PIT plot that remembers the last image it was given. """
+    def __init__(self, image_data) :
+        self.image_data = image_data
+
+    def set_image(self, image, **kwargs) :
+        self.image = image
+
+def _make_plugin(image_data) :
+    """ Return an ARPES_Plugin connected to stand-ins for PIT's main window, 
+    whose main_plot and cut_plot show *image_data*.
+    """
+    main_plot = _Recorder(image_data)
+    cut_plot = _Recorder(image_data)
+    main_window = type('MainWindow', (), {})()
+    main_window.main_plot = main_plot
+    main_window.cut_plot = cut_plot
+    main_window.lut = None
+    main_window.set_image = main_plot.set_image
+    return dap.ARPES_Plugin(main_window, None)
+
+@pytest.mark.parametrize('use_kernel', [True, False])
+@pytest.mark.parametrize('dtype', [float, int])
+@pytest.mark.parametrize('dim', [0, 1])
+@pytest.mark.parametrize('minimum', [False, True])
+@pytest.mark.parametrize('plot', ['main_plot', 'cut_plot'])
+def test_preview_normalization_matches_arpys(monkeypatch, plot, minimum, dim, 
+                                             dtype, use_kernel) :
+    if use_kernel :
+        pytest.importorskip('numba')
+    else :
+        monkeypatch.setattr(dap, '_normalize_cube', False)
+    image = np.arange(1, 13).reshape(3, 4).astype(dtype)
+    expected = pp.normalize_per_segment(image.astype(float), dim=dim, 
+                                        minimum=minimum)
+    plugin = _make_plugin(image.copy())
+    getattr(plugin, plot + '_normalize_per_segment')(dim=dim, min=minimum)
+    result = getattr(plugin.main_window, plot).image
+    assert np.allclose(result, expected)
+    # The displayed source image is left untouched
+    assert np.array_equal(getattr(plugin.main_window, plot).image_data, image)
+
+@pytest.mark.parametrize('orientation', ['horizontal', 'Vertical'])
+def test_angle_to_k_matches_arpys(orientation) :
+    alpha = np.linspace(-15, 15, 7)
+    beta = np.linspace(-8, 8, 5)
+    hv, work_func = 60, 4.2
+    dalphas, dbetas = np.array([3, -2]), np.array([5, 1])
+    plugin = dap.ARPES_Plugin(None, None)
+    KX, KY = plugin._angle_to_k_fast(alpha, beta, plugin._k0(hv, work_func), 
+                                     dalphas, dbetas, orientation)
+    assert KX.shape == KY.shape == (2, 7, 5)
+    for i, (dalpha, dbeta) in enumerate(zip(dalphas, dbetas)) :
+        kx, ky = pp.angle_to_k(alpha, beta, hv, dalpha=dalpha, dbeta=dbeta, 
+                               orientation=orientation, work_func=work_func)
+        assert np.allclose(KX[i], kx)
+        assert np.allclose(KY[i], ky)
+
+def test_batch_redraws_once_and_only_if_needed() :
+    plugin, alpha, beta = _make_a2k_plugin()
+    main_window = plugin.main_window
+    with plugin.batch() :
+        pass
+    assert main_window.redraws == 0
+
+    with plugin.batch() :
+        with plugin.batch() :
+            for dalpha in range(3) :
+                plugin.a2k(0, 1, dalpha=dalpha)
+        assert main_window.redraws == 0
+    assert main_window.redraws == 1
+
+    # A failing block must not redraw, so its exception comes through as is
+    with pytest.raises(KeyError) :
+        with plugin.batch() :
+            plugin.a2k(0, 1)
+            raise KeyError
+    assert main_window.redraws == 1